@@ -1,8 +1,20 @@
 import os
+import hashlib
+import hmac
+import json
 import logging
 import sys
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
-from asana import Client
+from asana import Client, error as asana_error
+from asana.client import STATUS_MAP
+import redis
+from jinja2 import Template
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
 
 app = Flask(__name__)
@@ -15,6 +27,15 @@ logger = logging.getLogger()
 asana_token = os.environ.get('ASANA_TOKEN')
 client = Client.access_token(asana_token)
 
+# Reuse keep-alive connections across threads and retry transient errors.
+# Mount on the client's own session so its token auth is kept, and hand the
+# final response back so the asana client can still handle rate limits.
+client.session.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504], raise_on_status=False)
+))
+
 # Original project ID - will be used as template reference
 TEMPLATE_PROJECT_ID = '1209353707682767'
 
@@ -23,54 +44,421 @@ STATUS_TASK_NAME = "Project Status"
 ESTIMATED_COST_FIELD = "Budget"  # Your actual custom field name
 ACTUAL_COST_FIELD = "Actual Cost"  # Your actual custom field name
 
-# Dictionary to store webhook secret dynamically
-WEBHOOK_SECRET = {}
+# Task fields needed to compute metrics, fetched alongside the task list
+TASK_FIELDS = ['name', 'custom_fields.gid', 'custom_fields.name', 'custom_fields.number_value']
+
+# Project fields needed to find projects with our custom fields in a single workspace scan
+PROJECT_FIELDS = ['gid', 'name', 'custom_field_settings.custom_field.gid', 'custom_field_settings.custom_field.name']
+
+# Results page for /update-status, compiled once at import
+STATUS_PAGE_TEMPLATE = Template("""
+        <html>
+        <head>
+            <title>Project Status Updated</title>
+            <style>
+                body { font-family: Arial, sans-serif; margin: 40px; line-height: 1.6; }
+                .success { color: green; font-weight: bold; }
+                .error { color: red; font-weight: bold; }
+                .container { max-width: 800px; margin: 0 auto; }
+                h1 { color: #333; }
+                .button { 
+                    display: inline-block; 
+                    background: #4CAF50; 
+                    color: white; 
+                    padding: 10px 20px; 
+                    text-decoration: none; 
+                    border-radius: 4px; 
+                    margin-top: 20px; 
+                }
+                table { width: 100%; border-collapse: collapse; margin-top: 20px; }
+                th, td { border: 1px solid #ddd; padding: 8px; text-align: left; }
+                th { background-color: #f2f2f2; }
+                tr:nth-child(even) { background-color: #f9f9f9; }
+            </style>
+        </head>
+        <body>
+            <div class="container">
+                <h1>Project Status Update Results</h1>
+                {% if successful > 0 %}
+                <p class="success">✅ Successfully updated {{ successful }} project(s)!</p>
+                {% else %}
+                <p class="error">❌ Failed to update any projects.</p>
+                {% endif %}
+                <p>Current time: {{ ts }}</p>
+                
+                <h2>Update Details</h2>
+                <table>
+                    <tr>
+                        <th>Project</th>
+                        <th>Status</th>
+                    </tr>
+                    {% for result in results.values() %}
+                    <tr>
+                        <td>{{ result.name }}</td>
+                        <td>{{ '✅ Updated' if result.success else '❌ Failed' }}</td>
+                    </tr>
+                    {% endfor %}
+                </table>
+                
+                <a href="/update-status" class="button">Update Again</a>
+            </div>
+        </body>
+        </html>
+        """, autoescape=True)
+
+# Page size for paginated conditional GETs
+PAGE_SIZE = 100
+
+# Maximum number of actions the Asana batch API accepts per request
+BATCH_SIZE = 10
+
+# Number of projects updated concurrently
+MAX_WORKERS = 8
+
+# Shared pool for running blocking Asana calls concurrently
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+# Separate pool for fanning out lookups, so they never wait behind project updates
+fetch_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+# Seconds to wait after a webhook so a burst of edits triggers a single update
+DEBOUNCE_SECONDS = 3
+
+# Projects waiting for the background worker to update them
+pending_projects = set()
+pending_lock = threading.Lock()
+pending_event = threading.Event()
+
+# Seconds a worker may hold, or wait for, a project's status task lock in Redis
+STATUS_TASK_LOCK_TIMEOUT = 30
+
+# Per-project locks so concurrent updates don't create duplicate status tasks,
+# used when there is no Redis to lock across workers
+status_task_locks = {}
+status_task_locks_lock = threading.Lock()
+
+# Webhook events waiting to be processed off the request thread
+event_queue = queue.Queue()
+
+# Cache key the webhook secret is stored under, shared by all workers through Redis
+WEBHOOK_SECRET_KEY = 'webhook_secret'
+
+# Cache key marking that /register-webhook is waiting for Asana's handshake,
+# and how many seconds the handshake is accepted for
+WEBHOOK_REGISTRATION_KEY = 'webhook_registration_pending'
+WEBHOOK_REGISTRATION_TTL = 60
+
+# Seconds to keep cached project lookups (custom field GIDs, workspace, name)
+CACHE_TTL = 3600
+
+# Seconds to keep a project's Project Status task GID
+STATUS_TASK_CACHE_TTL = 86400
+
+# Seconds to keep the list of workspace projects that have our custom fields
+WORKSPACE_CACHE_TTL = 300
+
+# Project webhook actions that can change which projects need updating
+PROJECT_CHANGE_ACTIONS = ('added', 'removed', 'changed')
+
+# Shared cache in Redis when REDIS_URL is set, so all gunicorn workers and
+# restarts reuse the same lookups; otherwise an in-process dict is used
+REDIS_URL = os.environ.get('REDIS_URL')
+redis_client = redis.from_url(REDIS_URL) if REDIS_URL else None
+REDIS_KEY_PREFIX = 'multiproject:'
+
+# Webhook registration and handshakes need state shared by all gunicorn workers:
+# the worker serving /register-webhook is blocked while another takes the handshake
+if not redis_client:
+    logger.error(
+        "REDIS_URL is not set: /register-webhook and webhook handshakes are disabled"
+        + ("" if os.environ.get('ASANA_WEBHOOK_SECRET') else
+           ", and with no ASANA_WEBHOOK_SECRET every webhook event will be rejected")
+    )
+
+# In-process cache of Asana lookups: {key: (value, expires_at)}
+CACHE = {}
+cache_lock = threading.Lock()
+
+def cache_get(key):
+    """Return a cached value, or None if it is missing or expired"""
+    if redis_client:
+        try:
+            value = redis_client.get(REDIS_KEY_PREFIX + key)
+            return json.loads(value) if value is not None else None
+        except redis.RedisError as e:
+            logger.error(f"Error reading {key} from Redis: {e}")
+            return None
+    
+    with cache_lock:
+        entry = CACHE.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.time():
+            del CACHE[key]
+            return None
+        return value
+
+def cache_set(key, value, ttl=CACHE_TTL):
+    """Store a value in the cache for ttl seconds, or indefinitely if ttl is None"""
+    if redis_client:
+        try:
+            redis_client.set(REDIS_KEY_PREFIX + key, json.dumps(value), ex=ttl)
+        except redis.RedisError as e:
+            logger.error(f"Error writing {key} to Redis: {e}")
+        return
+    
+    with cache_lock:
+        CACHE[key] = (value, time.time() + ttl if ttl is not None else float('inf'))
+
+def cache_delete(key):
+    """Remove a single entry from the cache"""
+    if redis_client:
+        try:
+            redis_client.delete(REDIS_KEY_PREFIX + key)
+        except redis.RedisError as e:
+            logger.error(f"Error deleting {key} from Redis: {e}")
+        return
+    
+    with cache_lock:
+        CACHE.pop(key, None)
+
+def invalidate_cache(project_id=None):
+    """Drop cached entries for a project, or everything if no project is given"""
+    if redis_client:
+        pattern = f"{REDIS_KEY_PREFIX}*:{project_id}" if project_id else f"{REDIS_KEY_PREFIX}*"
+        secret_key = (REDIS_KEY_PREFIX + WEBHOOK_SECRET_KEY).encode()
+        try:
+            keys = [key for key in redis_client.scan_iter(match=pattern) if key != secret_key]
+            if keys:
+                redis_client.delete(*keys)
+        except redis.RedisError as e:
+            logger.error(f"Error invalidating Redis cache: {e}")
+        return
+    
+    with cache_lock:
+        if project_id is None:
+            for key in [key for key in CACHE if key != WEBHOOK_SECRET_KEY]:
+                del CACHE[key]
+        else:
+            for key in [key for key in CACHE if key.endswith(f":{project_id}")]:
+                del CACHE[key]
+
+def get_webhook_secret():
+    """Get the current webhook secret, falling back to ASANA_WEBHOOK_SECRET"""
+    # Read the cache on every check so a re-registration reaches every worker
+    return cache_get(WEBHOOK_SECRET_KEY) or os.environ.get('ASANA_WEBHOOK_SECRET')
+
+def verify_webhook_signature(body, signature):
+    """Check an event's X-Hook-Signature against the webhook secret"""
+    secret = get_webhook_secret()
+    if not secret or not signature:
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    # Compare bytes, since compare_digest rejects str with non-ASCII characters
+    return hmac.compare_digest(expected.encode(), signature.encode('utf-8', 'surrogateescape'))
+
+# Last response per Asana GET URL for revalidation: {url: (etag, body)}
+ETAG_CACHE = {}
+etag_lock = threading.Lock()
+
+def conditional_get(path, params=None, revalidate=True):
+    """GET an Asana resource, sending If-None-Match so unchanged resources come back as 304"""
+    url = client.options['base_url'] + path
+    params = params or {}
+    cache_key = url + '?' + '&'.join(f"{key}={value}" for key, value in sorted(params.items()))
+    
+    cached = None
+    if revalidate:
+        with etag_lock:
+            cached = ETAG_CACHE.get(cache_key)
+    
+    headers = dict(client.headers)
+    if cached:
+        headers['If-None-Match'] = cached[0]
+    
+    # Map errors and retry rate limits and server errors the same way Client.request does
+    retry_count = 0
+    while True:
+        try:
+            response = client.session.get(url, params=params, headers=headers, auth=client.auth)
+            if response.status_code == 304 and cached:
+                return cached[1]
+            if response.status_code in STATUS_MAP:
+                raise STATUS_MAP[response.status_code](response)
+            elif 500 <= response.status_code < 600:
+                raise asana_error.ServerError(response)
+            break
+        except asana_error.RetryableAsanaError as e:
+            if retry_count < client.options['max_retries']:
+                client._handle_retryable_error(e, retry_count)
+                retry_count += 1
+            else:
+                raise e
+    response.raise_for_status()
+    
+    body = response.json()
+    etag = response.headers.get('ETag')
+    # Only keep complete responses, so a replayed body never carries a stale page offset
+    if revalidate and etag and not body.get('next_page'):
+        with etag_lock:
+            ETAG_CACHE[cache_key] = (etag, body)
+    return body
+
+def conditional_get_all(path, params=None):
+    """GET every page of an Asana collection, revalidating it when it fits on one page"""
+    params = dict(params or {}, limit=PAGE_SIZE)
+    items = []
+    while True:
+        # Later pages are keyed by an opaque offset token, so always fetch them live
+        body = conditional_get(path, params, revalidate='offset' not in params)
+        items.extend(body['data'])
+        next_page = body.get('next_page')
+        if not next_page:
+            return items
+        params['offset'] = next_page['offset']
+
+def batch_get(paths, fields=None):
+    """Fetch several resources with the Asana batch API, returning None for failed actions"""
+    def fetch_chunk(chunk):
+        actions = []
+        for path in chunk:
+            action = {'relative_path': path, 'method': 'get'}
+            if fields:
+                action['options'] = {'fields': fields}
+            actions.append(action)
+        
+        chunk_results = []
+        responses = client.post('/batch', {'actions': actions})
+        for path, response in zip(chunk, responses):
+            if response.get('status_code') == 200:
+                chunk_results.append(response['body']['data'])
+            else:
+                logger.error(f"Batch request for {path} failed with status {response.get('status_code')}")
+                chunk_results.append(None)
+        return chunk_results
+    
+    # Send the batch requests concurrently
+    chunks = [paths[start:start + BATCH_SIZE] for start in range(0, len(paths), BATCH_SIZE)]
+    return [result for chunk_results in fetch_executor.map(fetch_chunk, chunks) for result in chunk_results]
+
+def current_timestamp():
+    """Current local time formatted as YYYY-MM-DD HH:MM:SS"""
+    return datetime.now().replace(microsecond=0).isoformat(sep=' ')
+
+def fetch_project(project_id):
+    """Fetch a project and cache its workspace and name"""
+    project = conditional_get(f"/projects/{project_id}")['data']
+    cache_set(f"workspace:{project_id}", project['workspace']['gid'])
+    cache_set(f"project_name:{project_id}", project.get('name'))
+    return project
 
 def get_project_workspace(project_id):
     """Get the workspace ID for a given project"""
+    workspace_id = cache_get(f"workspace:{project_id}")
+    if workspace_id:
+        return workspace_id
     try:
-        project = client.projects.find_by_id(project_id)
+        project = fetch_project(project_id)
         return project['workspace']['gid']
     except Exception as e:
         logger.error(f"Error getting workspace for project {project_id}: {e}")
         return None
 
+def get_project_name(project_id, default=None):
+    """Get the name of a given project"""
+    project_name = cache_get(f"project_name:{project_id}")
+    if project_name:
+        return project_name
+    try:
+        project = fetch_project(project_id)
+        return project.get('name') or default
+    except Exception as e:
+        logger.error(f"Error getting name for project {project_id}: {e}")
+        return default
+
 def get_all_projects_in_workspace(workspace_id):
-    """Get all projects in a workspace"""
+    """Get all projects in a workspace, caching their names, workspace and custom field GIDs
+    
+    Returns None if the projects could not be fetched.
+    """
     try:
-        projects = client.projects.find_all({'workspace': workspace_id})
-        return list(projects)
+        projects = conditional_get_all('/projects', {
+            'workspace': workspace_id,
+            'opt_fields': ','.join(PROJECT_FIELDS)
+        })
+        for project in projects:
+            cache_set(f"workspace:{project['gid']}", workspace_id)
+            cache_set(f"project_name:{project['gid']}", project.get('name'))
+            if 'custom_field_settings' in project:
+                cache_set(f"custom_fields:{project['gid']}", parse_custom_field_settings(project['custom_field_settings']))
+        return projects
     except Exception as e:
         logger.error(f"Error getting projects for workspace {workspace_id}: {e}")
-        return []
+        return None
+
+def parse_custom_field_settings(custom_field_settings):
+    """Pick the Estimated Cost and Actual Cost field GIDs out of custom field settings"""
+    estimated_cost_gid = None
+    actual_cost_gid = None
+    
+    for setting in custom_field_settings:
+        field_name = setting['custom_field']['name']
+        if field_name == ESTIMATED_COST_FIELD:
+            estimated_cost_gid = setting['custom_field']['gid']
+        elif field_name == ACTUAL_COST_FIELD:
+            actual_cost_gid = setting['custom_field']['gid']
+    
+    return estimated_cost_gid, actual_cost_gid
 
 def get_custom_fields(project_id):
     """Get the custom field GIDs for Estimated Cost and Actual Cost fields"""
+    cached = cache_get(f"custom_fields:{project_id}")
+    if cached:
+        return cached
     try:
         # Get all custom field settings for the project
-        custom_field_settings = client.custom_field_settings.find_by_project(project_id)
-        
-        estimated_cost_gid = None
-        actual_cost_gid = None
-        
-        for setting in custom_field_settings:
-            field_name = setting['custom_field']['name']
-            if field_name == ESTIMATED_COST_FIELD:
-                estimated_cost_gid = setting['custom_field']['gid']
-            elif field_name == ACTUAL_COST_FIELD:
-                actual_cost_gid = setting['custom_field']['gid']
+        custom_field_settings = conditional_get_all(f"/projects/{project_id}/custom_field_settings")
+        estimated_cost_gid, actual_cost_gid = parse_custom_field_settings(custom_field_settings)
         
+        cache_set(f"custom_fields:{project_id}", (estimated_cost_gid, actual_cost_gid))
         return estimated_cost_gid, actual_cost_gid
     except Exception as e:
         logger.error(f"Error getting custom fields for project {project_id}: {e}")
         return None, None
 
+def get_projects_with_custom_fields(workspace_id):
+    """Get the IDs of all projects in a workspace that have our custom fields"""
+    cache_key = f"workspace_projects:{workspace_id}"
+    project_ids = cache_get(cache_key)
+    if project_ids is not None:
+        return project_ids
+    
+    projects = get_all_projects_in_workspace(workspace_id)
+    if projects is None:
+        # Don't cache a failed scan, so the next request tries again
+        return []
+    
+    project_ids = []
+    for project in projects:
+        project_id = project['gid']
+        estimated, actual = get_custom_fields(project_id)
+        if estimated and actual:
+            project_ids.append(project_id)
+    
+    cache_set(cache_key, project_ids, WORKSPACE_CACHE_TTL)
+    return project_ids
+
 def find_status_task(project_id):
     """Find the Project Status task in the project"""
+    status_task_gid = cache_get(f"status_task:{project_id}")
+    if status_task_gid:
+        return status_task_gid
     try:
-        tasks = client.tasks.find_by_project(project_id)
+        tasks = client.tasks.find_by_project(project_id, fields=['name'])
         for task in tasks:
             if task['name'] == STATUS_TASK_NAME:
+                cache_set(f"status_task:{project_id}", task['gid'], STATUS_TASK_CACHE_TTL)
                 return task['gid']
         return None
     except Exception as e:
@@ -93,37 +481,67 @@ def create_status_task(project_id):
             'notes': "This task contains summary information about the project budget."
         })
         logger.info(f"Created Project Status task with GID: {task['gid']} for project {project_id}")
+        cache_set(f"status_task:{project_id}", task['gid'], STATUS_TASK_CACHE_TTL)
         return task['gid']
     except Exception as e:
         logger.error(f"Error creating status task for project {project_id}: {e}")
         return None
 
+def find_or_create_status_task(project_id):
+    """Find the Project Status task, creating it if it doesn't exist"""
+    if redis_client:
+        # Lock across every worker sharing this Redis
+        lock = redis_client.lock(
+            f"{REDIS_KEY_PREFIX}status_task_lock:{project_id}",
+            timeout=STATUS_TASK_LOCK_TIMEOUT,
+            blocking_timeout=STATUS_TASK_LOCK_TIMEOUT
+        )
+        try:
+            acquired = lock.acquire()
+        except redis.RedisError as e:
+            logger.error(f"Error locking status task for project {project_id} in Redis: {e}")
+            acquired = False
+        if not acquired:
+            # Another worker may be creating it, so only look it up to avoid a duplicate
+            return find_status_task(project_id)
+        try:
+            return find_status_task(project_id) or create_status_task(project_id)
+        finally:
+            try:
+                lock.release()
+            except redis.RedisError as e:
+                logger.error(f"Error releasing status task lock for project {project_id}: {e}")
+    
+    with status_task_locks_lock:
+        lock = status_task_locks.setdefault(project_id, threading.Lock())
+    with lock:
+        return find_status_task(project_id) or create_status_task(project_id)
+
 def update_project_metrics(project_id):
     """Calculate project metrics and update the Project Status task"""
     try:
         # Get current timestamp
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        current_time = current_timestamp()
         
         estimated_cost_gid, actual_cost_gid = get_custom_fields(project_id)
         if not estimated_cost_gid or not actual_cost_gid:
             logger.warning(f"Could not find custom field GIDs for project {project_id}")
             return False
         
-        # Get all tasks in the project
-        tasks = client.tasks.find_by_project(project_id)
+        # Get all tasks in the project, including their custom field values
+        tasks = client.tasks.find_by_project(project_id, fields=TASK_FIELDS)
         
         total_estimated = 0
         total_actual = 0
+        total_overbudget = 0
         completed_tasks = 0
         total_tasks = 0
         overbudget_tasks = []
         
         # Find status task or create if not exists
-        status_task_gid = find_status_task(project_id)
+        status_task_gid = find_or_create_status_task(project_id)
         if not status_task_gid:
-            status_task_gid = create_status_task(project_id)
-            if not status_task_gid:
-                return False
+            return False
         
         # Process each task
         for task in tasks:
@@ -133,17 +551,14 @@ def update_project_metrics(project_id):
             if task_gid == status_task_gid:
                 continue
             
-            # Get full task details to access custom fields
-            task_details = client.tasks.find_by_id(task_gid)
-            
             total_tasks += 1
             
             # Extract costs from custom fields
             estimated_cost = 0
             actual_cost = 0
             
-            if 'custom_fields' in task_details:
-                for field in task_details['custom_fields']:
+            if 'custom_fields' in task:
+                for field in task['custom_fields']:
                     if field['gid'] == estimated_cost_gid and field.get('number_value') is not None:
                         estimated_cost = field['number_value']
                     elif field['gid'] == actual_cost_gid and field.get('number_value') is not None:
@@ -159,6 +574,7 @@ def update_project_metrics(project_id):
                 
                 # Check if task is over budget
                 if actual_cost > estimated_cost:
+                    total_overbudget += actual_cost - estimated_cost
                     overbudget_tasks.append({
                         'name': task['name'],
                         'estimated': estimated_cost,
@@ -171,10 +587,9 @@ def update_project_metrics(project_id):
         budget_progress = (total_actual / total_estimated * 100) if total_estimated > 0 else 0
         
         # Get project name
-        project_info = client.projects.find_by_id(project_id)
-        project_name = project_info.get('name', 'Construction Project')
+        project_name = get_project_name(project_id, 'Construction Project')
         
-        summary = f"""# 🏗️ {project_name} Budget Summary
+        summary_parts = [f"""# 🏗️ {project_name} Budget Summary
 
 ## 💰 Overall Budget
 - 💵 Total Estimated Budget: ${total_estimated:.2f}
@@ -187,19 +602,21 @@ def update_project_metrics(project_id):
 - ✅ Completed Tasks (with actual costs): {completed_tasks}
 - 🚧 Project Completion: {percent_complete:.1f}%
 
-"""
+"""]
         
         # Add overbudget section if there are overbudget tasks
         if overbudget_tasks:
-            summary += "## ⚠️ Overbudget Items\n"
-            for item in overbudget_tasks:
-                summary += f"- ❗ {item['name']}: Estimated ${item['estimated']:.2f}, Actual ${item['actual']:.2f} (${item['difference']:.2f} over budget)\n"
+            summary_parts.append("## ⚠️ Overbudget Items\n")
+            summary_parts.append(''.join([
+                f"- ❗ {item['name']}: Estimated ${item['estimated']:.2f}, Actual ${item['actual']:.2f} (${item['difference']:.2f} over budget)\n"
+                for item in overbudget_tasks
+            ]))
             
-            total_overbudget = sum(item['difference'] for item in overbudget_tasks)
-            summary += f"\n⚠️ Total Amount Over Budget: ${total_overbudget:.2f}\n"
+            summary_parts.append(f"\n⚠️ Total Amount Over Budget: ${total_overbudget:.2f}\n")
         
         # Add last updated timestamp
-        summary += f"\n\n🕒 Last Updated: {current_time}"
+        summary_parts.append(f"\n\n🕒 Last Updated: {current_time}")
+        summary = ''.join(summary_parts)
         
         # Update the status task
         client.tasks.update(status_task_gid, {
@@ -211,82 +628,150 @@ def update_project_metrics(project_id):
         
     except Exception as e:
         logger.error(f"Error updating project metrics for project {project_id}: {e}")
+        # The cached status task may have been deleted, so look it up again next time
+        cache_delete(f"status_task:{project_id}")
         return False
 
+def update_projects(project_ids, update=update_project_metrics):
+    """Run a per-project update concurrently and return {project_id: result}"""
+    return dict(zip(project_ids, executor.map(update, project_ids)))
+
+def schedule_project_updates(project_ids):
+    """Queue projects for the background worker to update"""
+    with pending_lock:
+        pending_projects.update(project_ids)
+    pending_event.set()
+
+def process_pending_updates():
+    """Background worker that updates each pending project once per debounce window"""
+    while True:
+        pending_event.wait()
+        time.sleep(DEBOUNCE_SECONDS)
+        
+        with pending_lock:
+            project_ids = list(pending_projects)
+            pending_projects.clear()
+            pending_event.clear()
+        
+        try:
+            logger.info(f"Updating project metrics for projects {project_ids}")
+            results = update_projects(project_ids)
+            logger.info(f"Finished updating projects: {results}")
+        except Exception as e:
+            logger.error(f"Error updating pending projects {project_ids}: {e}")
+
+update_worker = threading.Thread(target=process_pending_updates, daemon=True)
+update_worker.start()
+
+def process_webhook_events():
+    """Background worker that turns queued webhook events into project updates"""
+    while True:
+        event_data = event_queue.get()
+        try:
+            projects_to_update = determine_projects_to_update(event_data)
+            schedule_project_updates(projects_to_update)
+        except Exception as e:
+            logger.error(f"Error processing webhook event: {e}")
+        finally:
+            event_queue.task_done()
+
+event_worker = threading.Thread(target=process_webhook_events, daemon=True)
+event_worker.start()
+
 def determine_projects_to_update(event_data=None):
     """Determine which projects to update based on webhook event or manual trigger"""
-    projects_to_update = []
+    projects_to_update = set()
     
     if event_data and 'events' in event_data:
-        # Extract project IDs from the webhook event
+        # Collect the tasks referenced by the webhook event
+        task_gids = set()
         for event in event_data['events']:
-            if 'resource' in event and event.get('resource', {}).get('resource_type') == 'task':
-                task_gid = event.get('resource', {}).get('gid')
+            resource = event.get('resource') or {}
+            if resource.get('resource_type') == 'project' and event.get('action') in PROJECT_CHANGE_ACTIONS:
+                # Project was added, removed or changed, so cached lookups may be stale.
+                # Without a gid, only the workspace list is dropped, not the whole cache.
+                if resource.get('gid'):
+                    invalidate_cache(resource['gid'])
+                workspace_id = get_project_workspace(TEMPLATE_PROJECT_ID)
+                cache_delete(f"workspace_projects:{workspace_id}")
+            elif resource.get('resource_type') == 'task':
+                task_gid = resource.get('gid')
                 if task_gid:
-                    # Get the projects this task belongs to
-                    try:
-                        task = client.tasks.find_by_id(task_gid)
-                        if 'projects' in task:
-                            for project in task['projects']:
-                                project_id = project['gid']
-                                if project_id not in projects_to_update:
-                                    # Verify this project has our custom fields
-                                    estimated, actual = get_custom_fields(project_id)
-                                    if estimated and actual:
-                                        projects_to_update.append(project_id)
-                    except Exception as e:
-                        logger.error(f"Error getting task details for task {task_gid}: {e}")
+                    task_gids.add(task_gid)
+        
+        # Projects with our custom fields, known from the cached workspace scan,
+        # looked up while the tasks are being fetched
+        workspace_id = get_project_workspace(TEMPLATE_PROJECT_ID) if task_gids else None
+        eligible_future = fetch_executor.submit(get_projects_with_custom_fields, workspace_id) if workspace_id else None
+        
+        # Get the projects these tasks belong to in batched requests
+        try:
+            tasks = batch_get([f"/tasks/{task_gid}" for task_gid in task_gids], fields=['projects.gid'])
+        except Exception as e:
+            logger.error(f"Error getting task details for tasks {task_gids}: {e}")
+            tasks = []
+        
+        eligible_projects = set(eligible_future.result()) if eligible_future else set()
+        
+        for task in tasks:
+            if task and 'projects' in task:
+                for project in task['projects']:
+                    project_id = project['gid']
+                    if project_id in eligible_projects:
+                        projects_to_update.add(project_id)
     
     # If no projects were found from the event, or this is a manual trigger
     if not projects_to_update:
         # Get the workspace of our template project
         workspace_id = get_project_workspace(TEMPLATE_PROJECT_ID)
         if workspace_id:
-            # Get all projects in the workspace
-            all_projects = get_all_projects_in_workspace(workspace_id)
-            
-            # Check each project for our custom fields
-            for project in all_projects:
-                project_id = project['gid']
-                estimated, actual = get_custom_fields(project_id)
-                if estimated and actual:
-                    projects_to_update.append(project_id)
+            # Get all projects in the workspace that have our custom fields
+            projects_to_update.update(get_projects_with_custom_fields(workspace_id))
     
-    return projects_to_update
+    return list(projects_to_update)
 
 @app.route('/webhook', methods=['POST'])
 def handle_webhook():
     """Handles incoming webhook requests from Asana"""
     # Check if this is the webhook handshake request
     if 'X-Hook-Secret' in request.headers:
+        if not redis_client:
+            logger.error("Rejected webhook handshake: REDIS_URL is required to share the webhook secret")
+            return jsonify({"status": "error", "message": "REDIS_URL is not configured"}), 503
+        
+        # Only accept a handshake for a registration we started, otherwise anyone
+        # could replace the secret and take over the endpoint
+        if not cache_get(WEBHOOK_REGISTRATION_KEY):
+            logger.warning("Rejected webhook handshake with no registration in progress")
+            return jsonify({"status": "error", "message": "No webhook registration in progress"}), 403
+        cache_delete(WEBHOOK_REGISTRATION_KEY)
+        
         secret = request.headers['X-Hook-Secret']
-        WEBHOOK_SECRET['secret'] = secret  # Store secret dynamically
+        cache_set(WEBHOOK_SECRET_KEY, secret, ttl=None)
         
         response = jsonify({})
         response.headers['X-Hook-Secret'] = secret  # Send back the secret
          
-        logger.info(f"Webhook Handshake Successful. Secret: {secret}")
+        logger.info("Webhook Handshake Successful")
         return response, 200
     
-    # If it's not a handshake, it's an event
+    # If it's not a handshake, it's an event - reject it unless Asana signed it
+    if not get_webhook_secret():
+        logger.error("Rejected webhook event: no webhook secret is configured")
+        return jsonify({"status": "error", "message": "No webhook secret configured"}), 503
+    if not verify_webhook_signature(request.get_data(), request.headers.get('X-Hook-Signature')):
+        logger.warning("Rejected webhook event with missing or invalid signature")
+        return jsonify({"status": "error", "message": "Invalid signature"}), 401
+    
     try:
         # Get the request data
         event_data = request.json
         logger.info(f"Received webhook event: {event_data}")
         
-        # Determine which projects to update
-        projects_to_update = determine_projects_to_update(event_data)
-        
-        update_results = {}
-        for project_id in projects_to_update:
-            logger.info(f"Updating project metrics for project {project_id}")
-            success = update_project_metrics(project_id)
-            update_results[project_id] = success
+        # Process the event in the background so Asana gets a quick response
+        event_queue.put(event_data)
             
-        return jsonify({
-            "status": "received", 
-            "updated_projects": update_results
-        }), 200
+        return jsonify({"status": "queued"}), 200
     except Exception as e:
         logger.error(f"Error processing webhook: {str(e)}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -296,16 +781,14 @@ def setup():
     """Setup endpoint to initialize all project status tasks and metrics"""
     projects_to_update = determine_projects_to_update()
     
-    results = {}
-    for project_id in projects_to_update:
+    def setup_project(project_id):
         # Find or create status task
-        status_task_gid = find_status_task(project_id)
-        if not status_task_gid:
-            status_task_gid = create_status_task(project_id)
+        find_or_create_status_task(project_id)
         
         # Update metrics
-        success = update_project_metrics(project_id)
-        results[project_id] = success
+        return update_project_metrics(project_id)
+    
+    results = update_projects(projects_to_update, setup_project)
     
     if any(results.values()):
         return jsonify({
@@ -328,6 +811,12 @@ def health():
 @app.route('/register-webhook', methods=['GET'])
 def register_webhook():
     """Register webhooks for all projects"""
+    if not redis_client:
+        return jsonify({
+            "status": "error",
+            "message": "REDIS_URL must be set so every worker can see the webhook handshake and secret"
+        }), 500
+    
     try:
         # Force HTTPS for Railway app URL
         webhook_url = "https://asanaconnector2claude-production.up.railway.app/webhook"
@@ -340,11 +829,16 @@ def register_webhook():
                 "message": "Could not determine workspace ID"
             }), 500
             
-        # Register a webhook for the workspace instead of individual projects
-        webhook = client.webhooks.create({
-            'resource': workspace_id,
-            'target': webhook_url
-        })
+        # Register a webhook for the workspace instead of individual projects.
+        # Asana sends the handshake while this call is in flight.
+        cache_set(WEBHOOK_REGISTRATION_KEY, True, WEBHOOK_REGISTRATION_TTL)
+        try:
+            webhook = client.webhooks.create({
+                'resource': workspace_id,
+                'target': webhook_url
+            })
+        finally:
+            cache_delete(WEBHOOK_REGISTRATION_KEY)
         
         logger.info(f"Webhook registered for workspace {workspace_id}: {webhook['gid']}")
         return jsonify({
@@ -361,15 +855,28 @@ def register_webhook():
             "message": f"Failed to register webhook: {str(e)}"
         }), 500
 
+@app.route('/invalidate-cache', methods=['GET'])
+def invalidate_cache_endpoint():
+    """Clear cached project lookups, optionally for a single project"""
+    project_id = request.args.get('project_id')
+    invalidate_cache(project_id)
+    if project_id:
+        # The project may have gained or lost our custom fields, so rescan eligibility too
+        workspace_id = get_project_workspace(TEMPLATE_PROJECT_ID)
+        cache_delete(f"workspace_projects:{workspace_id}")
+    
+    logger.info(f"Cache invalidated for {project_id or 'all projects'}")
+    return jsonify({
+        "status": "success",
+        "message": f"Cache invalidated for {project_id or 'all projects'}"
+    }), 200
+
 @app.route('/update', methods=['GET'])
 def manual_update():
     """Manually trigger an update of all Project Status tasks"""
     projects_to_update = determine_projects_to_update()
     
-    results = {}
-    for project_id in projects_to_update:
-        success = update_project_metrics(project_id)
-        results[project_id] = success
+    results = update_projects(projects_to_update)
     
     if any(results.values()):
         return jsonify({
@@ -390,96 +897,24 @@ def update_status():
     try:
         projects_to_update = determine_projects_to_update()
         
-        results = {}
-        for project_id in projects_to_update:
+        def update_and_name(project_id):
             success = update_project_metrics(project_id)
             
             # Get project name for display
-            try:
-                project_info = client.projects.find_by_id(project_id)
-                project_name = project_info.get('name', f'Project {project_id}')
-            except:
-                project_name = f'Project {project_id}'
+            project_name = get_project_name(project_id, f'Project {project_id}')
                 
-            results[project_id] = {
+            return {
                 'success': success,
                 'name': project_name
             }
         
+        results = update_projects(projects_to_update, update_and_name)
+        
         # Count successful updates
         successful_updates = sum(1 for result in results.values() if result['success'])
         
         # Return an HTML page with results
-        html_response = """
-        <html>
-        <head>
-            <title>Project Status Updated</title>
-            <style>
-                body { font-family: Arial, sans-serif; margin: 40px; line-height: 1.6; }
-                .success { color: green; font-weight: bold; }
-                .error { color: red; font-weight: bold; }
-                .container { max-width: 800px; margin: 0 auto; }
-                h1 { color: #333; }
-                .button { 
-                    display: inline-block; 
-                    background: #4CAF50; 
-                    color: white; 
-                    padding: 10px 20px; 
-                    text-decoration: none; 
-                    border-radius: 4px; 
-                    margin-top: 20px; 
-                }
-                table { width: 100%; border-collapse: collapse; margin-top: 20px; }
-                th, td { border: 1px solid #ddd; padding: 8px; text-align: left; }
-                th { background-color: #f2f2f2; }
-                tr:nth-child(even) { background-color: #f9f9f9; }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>Project Status Update Results</h1>
-        """
-        
-        if successful_updates > 0:
-            html_response += f"""
-                <p class="success">✅ Successfully updated {successful_updates} project(s)!</p>
-            """
-        else:
-            html_response += """
-                <p class="error">❌ Failed to update any projects.</p>
-            """
-        
-        html_response += f"""
-                <p>Current time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}</p>
-                
-                <h2>Update Details</h2>
-                <table>
-                    <tr>
-                        <th>Project</th>
-                        <th>Status</th>
-                    </tr>
-        """
-        
-        # Add rows for each project
-        for project_id, result in results.items():
-            status_text = "✅ Updated" if result['success'] else "❌ Failed"
-            html_response += f"""
-                    <tr>
-                        <td>{result['name']}</td>
-                        <td>{status_text}</td>
-                    </tr>
-            """
-        
-        html_response += """
-                </table>
-                
-                <a href="/update-status" class="button">Update Again</a>
-            </div>
-        </body>
-        </html>
-        """
-        
-        return html_response
+        return STATUS_PAGE_TEMPLATE.render(results=results, successful=successful_updates, ts=current_timestamp())
         
     except Exception as e:
         logger.error(f"Error in update-status endpoint: {e}")